@@ -19,11 +19,10 @@ from telegram.ext import (
 from telegram.constants import ParseMode, ChatAction
 
 import config
-import database
+from database import db
 import gemini_utils  # تغییر از openai_utils به gemini_utils
 
 # تنظیمات
-db = database.Database()
 logger = logging.getLogger(__name__)
 
 HELP_MESSAGE = """Commands:
@@ -57,27 +56,27 @@ def split_text_into_chunks(text, chunk_size):
         yield text[i:i + chunk_size]
 
 async def register_user_if_not_exists(update: Update, context: CallbackContext, user: User):
-    if not db.check_if_user_exists(user.id):
-        db.add_new_user(
+    if not await db.check_if_user_exists(user.id):
+        await db.add_new_user(
             user.id,
             update.message.chat_id,
             username=user.username,
             first_name=user.first_name,
             last_name=user.last_name
         )
-        db.start_new_dialog(user.id)
+        await db.start_new_dialog(user.id)
 
-    if db.get_user_attribute(user.id, "current_dialog_id") is None:
-        db.start_new_dialog(user.id)
+    if await db.get_user_attribute(user.id, "current_dialog_id") is None:
+        await db.start_new_dialog(user.id)
 
     if user.id not in user_semaphores:
         user_semaphores[user.id] = asyncio.Semaphore(1)
 
-    if db.get_user_attribute(user.id, "current_model") is None:
-        db.set_user_attribute(user.id, "current_model", config.models["available_text_models"][0])
+    if await db.get_user_attribute(user.id, "current_model") is None:
+        await db.set_user_attribute(user.id, "current_model", config.models["available_text_models"][0])
 
-    if db.get_user_attribute(user.id, "n_used_tokens") is None:
-        db.set_user_attribute(user.id, "n_used_tokens", {
+    if await db.get_user_attribute(user.id, "n_used_tokens") is None:
+        await db.set_user_attribute(user.id, "n_used_tokens", {
             "gemini-1.5-flash": {"n_input_tokens": 0, "n_output_tokens": 0}
         })
 
@@ -102,8 +101,8 @@ async def is_bot_mentioned(update: Update, context: CallbackContext):
 async def start_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-    db.start_new_dialog(user_id)
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.start_new_dialog(user_id)
 
     reply_text = "Hi! I'm <b>Gemini</b> bot powered by Google AI 🤖\n\n"
     reply_text += HELP_MESSAGE
@@ -113,13 +112,13 @@ async def start_handle(update: Update, context: CallbackContext):
 async def help_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
     await update.message.reply_text(HELP_MESSAGE, parse_mode=ParseMode.HTML)
 
 async def help_group_chat_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
     text = HELP_GROUP_CHAT_MESSAGE.format(bot_username="@" + context.bot.username)
     await update.message.reply_text(text, parse_mode=ParseMode.HTML)
     await update.message.reply_video(config.help_group_chat_video_path)
@@ -129,15 +128,15 @@ async def retry_handle(update: Update, context: CallbackContext):
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
-    dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
+    dialog_messages = await db.get_dialog_messages(user_id, dialog_id=None)
     if len(dialog_messages) == 0:
         await update.message.reply_text("No message to retry 🤷‍♂️")
         return
 
     last_dialog_message = dialog_messages.pop()
-    db.set_dialog_messages(user_id, dialog_messages, dialog_id=None)
+    await db.set_dialog_messages(user_id, dialog_messages, dialog_id=None)
     await message_handle(update, context, message=last_dialog_message["user"], use_new_dialog_timeout=False)
 
 async def message_handle(update: Update, context: CallbackContext, message=None, use_new_dialog_timeout=True):
@@ -156,17 +155,17 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+    chat_mode = await db.get_user_attribute(user_id, "current_chat_mode")
 
     async def message_handle_fn():
         if use_new_dialog_timeout:
-            if (datetime.now() - db.get_user_attribute(user_id, "last_interaction")).seconds > config.new_dialog_timeout:
-                db.start_new_dialog(user_id)
+            if (datetime.now() - await db.get_user_attribute(user_id, "last_interaction")).seconds > config.new_dialog_timeout:
+                await db.start_new_dialog(user_id)
                 await update.message.reply_text(f"Starting new dialog (<b>{config.chat_modes[chat_mode]['name']}</b> mode) ✅", parse_mode=ParseMode.HTML)
-        db.set_user_attribute(user_id, "last_interaction", datetime.now())
+        await db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
         n_input_tokens, n_output_tokens = 0, 0
-        current_model = db.get_user_attribute(user_id, "current_model")
+        current_model = await db.get_user_attribute(user_id, "current_model")
 
         try:
             placeholder_message = await update.message.reply_text("...")
@@ -176,7 +175,7 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
                 await update.message.reply_text("🥲 You sent <b>empty message</b>. Please, try again!", parse_mode=ParseMode.HTML)
                 return
 
-            dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
+            dialog_messages = await db.get_dialog_messages(user_id, dialog_id=None)
             parse_mode = config.chat_modes[chat_mode]["parse_mode"]
 
             gemini_instance = gemini_utils.GeminiChat(model=current_model)
@@ -211,15 +210,11 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
                 prev_answer = answer
 
             new_dialog_message = {"user": _message, "bot": answer, "date": datetime.now()}
-            db.set_dialog_messages(
-                user_id,
-                db.get_dialog_messages(user_id, dialog_id=None) + [new_dialog_message],
-                dialog_id=None
-            )
-            db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
+            await db.append_dialog_message(user_id, new_dialog_message, dialog_id=None)
+            await db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
 
         except asyncio.CancelledError:
-            db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
+            await db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
             raise
         except Exception as e:
             error_text = f"Something went wrong: {e}"
@@ -257,16 +252,16 @@ async def new_dialog_handle(update: Update, context: CallbackContext):
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-    db.start_new_dialog(user_id)
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.start_new_dialog(user_id)
     await update.message.reply_text("Starting new dialog ✅")
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+    chat_mode = await db.get_user_attribute(user_id, "current_chat_mode")
     await update.message.reply_text(f"{config.chat_modes[chat_mode]['welcome_message']}", parse_mode=ParseMode.HTML)
 
 async def cancel_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
     if user_id in user_tasks:
         task = user_tasks[user_id]
         task.cancel()
@@ -301,7 +296,7 @@ async def show_chat_modes_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     if await is_previous_message_not_answered_yet(update, context): return
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
     text, reply_markup = get_chat_mode_menu(0)
     await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
@@ -309,7 +304,7 @@ async def show_chat_modes_callback_handle(update: Update, context: CallbackConte
     await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
     if await is_previous_message_not_answered_yet(update.callback_query, context): return
     user_id = update.callback_query.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
     query = update.callback_query
     await query.answer()
     page_index = int(query.data.split("|")[1])
@@ -328,16 +323,16 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
     chat_mode = query.data.split("|")[1]
-    db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
-    db.start_new_dialog(user_id)
+    await db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
+    await db.start_new_dialog(user_id)
     await context.bot.send_message(
         update.callback_query.message.chat.id,
         f"{config.chat_modes[chat_mode]['welcome_message']}",
         parse_mode=ParseMode.HTML
     )
 
-def get_settings_menu(user_id: int):
-    current_model = db.get_user_attribute(user_id, "current_model")
+async def get_settings_menu(user_id: int):
+    current_model = await db.get_user_attribute(user_id, "current_model")
     text = config.models["info"][current_model]["description"]
     text += "\n\nSelect <b>model</b>:"
     buttons = []
@@ -353,8 +348,8 @@ async def settings_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     if await is_previous_message_not_answered_yet(update, context): return
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-    text, reply_markup = get_settings_menu(user_id)
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    text, reply_markup = await get_settings_menu(user_id)
     await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
 async def set_settings_handle(update: Update, context: CallbackContext):
@@ -363,9 +358,9 @@ async def set_settings_handle(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
     _, model_key = query.data.split("|")
-    db.set_user_attribute(user_id, "current_model", model_key)
-    db.start_new_dialog(user_id)
-    text, reply_markup = get_settings_menu(user_id)
+    await db.set_user_attribute(user_id, "current_model", model_key)
+    await db.start_new_dialog(user_id)
+    text, reply_markup = await get_settings_menu(user_id)
     try:
         await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
     except telegram.error.BadRequest as e:
@@ -398,6 +393,7 @@ async def error_handle(update: Update, context: CallbackContext) -> None:
         await context.bot.send_message(update.effective_chat.id, "Some error in error handler")
 
 async def post_init(application: Application):
+    await db.setup()
     await application.bot.set_my_commands([
         BotCommand("/new", "Start new dialog"),
         BotCommand("/mode", "Select chat mode"),
@@ -1,13 +1,36 @@
+import pickle
 import yaml
 import dotenv
 from pathlib import Path
 
+# لودر C (libyaml) در صورت وجود — حدود ۱۰ برابر سریع‌تر از SafeLoader خالص پایتون
+_YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 # مسیر دایرکتوری تنظیمات
 config_dir = Path(__file__).parent.parent.resolve() / "config"
 
+
+def _load_cached_yaml(path: Path):
+    """بارگذاری YAML با کش pickle بر اساس mtime فایل، برای استارت سریع‌تر."""
+    cache_path = path.with_suffix(".yml.pkl")
+    try:
+        if cache_path.stat().st_mtime >= path.stat().st_mtime:
+            with open(cache_path, "rb") as f:
+                return pickle.load(f)
+    except (OSError, pickle.PickleError, EOFError):
+        pass  # کش وجود ندارد یا خراب است — از YAML می‌خوانیم
+    with open(path, "r") as f:
+        data = yaml.load(f, Loader=_YamlLoader)
+    try:
+        with open(cache_path, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass  # دایرکتوری فقط-خواندنی؛ کش اختیاری است
+    return data
+
+
 # بارگذاری فایل YAML
-with open(config_dir / "config.yml", 'r') as f:
-    config_yaml = yaml.safe_load(f)
+config_yaml = _load_cached_yaml(config_dir / "config.yml")
 
 # بارگذاری فایل .env
 config_env = dotenv.dotenv_values(config_dir / "config.env")
@@ -19,15 +42,19 @@ allowed_telegram_usernames = config_yaml.get("allowed_telegram_usernames", [])
 new_dialog_timeout = config_yaml.get("new_dialog_timeout", 600)  # پیش‌فرض: 10 دقیقه
 enable_message_streaming = config_yaml.get("enable_message_streaming", True)
 n_chat_modes_per_page = config_yaml.get("n_chat_modes_per_page", 5)
+dialog_ttl_seconds = config_yaml.get("dialog_ttl_seconds", 60 * 60 * 24 * 90)  # پیش‌فرض: ۹۰ روز
+max_dialog_turns = config_yaml.get("max_dialog_turns", 20)  # حداکثر نوبت‌های تاریخچه در پرامپت
 mongodb_uri = f"mongodb://mongo:{config_env['MONGODB_PORT']}"
 
 # حالت‌های چت
-with open(config_dir / "chat_modes.yml", 'r') as f:
-    chat_modes = yaml.safe_load(f)
+chat_modes = _load_cached_yaml(config_dir / "chat_modes.yml")
+
+# جدول‌های مسطح برای مسیر داغ: اعتبارسنجی O(1) و دسترسی مستقیم به پرامپت
+chat_mode_names = frozenset(chat_modes)
+chat_mode_prompts = {k: v["prompt_start"] for k, v in chat_modes.items()}
 
 # مدل‌ها
-with open(config_dir / "models.yml", 'r') as f:
-    models = yaml.safe_load(f)
+models = _load_cached_yaml(config_dir / "models.yml")
 
 # فایل‌های استاتیک
 help_group_chat_video_path = Path(__file__).parent.parent.resolve() / "static" / "help_group.mp4"
\ No newline at end of file
@@ -1,7 +1,11 @@
 from typing import Optional, Any, List, Dict
+import bson
 import pymongo
-from pymongo.errors import ConnectionError
+from pymongo.errors import PyMongoError
+from motor.motor_asyncio import AsyncIOMotorClient
 import uuid
+import time
+import asyncio
 from datetime import datetime
 import logging
 import config
@@ -11,29 +15,51 @@ logger = logging.getLogger(__name__)
 class Database:
     def __init__(self):
         """
-        Initialize MongoDB client and collections.
-        Raises ConnectionError if MongoDB connection fails.
+        Initialize the async MongoDB client and collections.
+        The Motor client connects lazily — call setup() once an event loop
+        is running to ping the server and create indexes.
         """
+        if not bson.has_c():
+            # Pure-Python BSON encoding is 5-10x slower on nested documents;
+            # every insert/update silently pays the tax.
+            logger.warning("pymongo C extensions not loaded — reinstall pymongo with build tools for fast BSON encoding")
+        self.client = AsyncIOMotorClient(
+            config.mongodb_uri,
+            serverSelectionTimeoutMS=5000,
+            maxPoolSize=50,
+            minPoolSize=5,
+            waitQueueTimeoutMS=2500,
+        )
+        self.db = self.client["chatgpt_telegram_bot"]
+        self.user_collection = self.db["user"]
+        self.dialog_collection = self.db["dialog"]
+        # Per-process cache of each user's current_dialog_id, TTL-bounded by
+        # new_dialog_timeout (after which a new dialog is started anyway).
+        self._current_dialog_cache: Dict[int, tuple] = {}
+        # Users confirmed to exist — the bot never deletes users at runtime,
+        # so a hit here skips the existence query entirely.
+        self._known_users: set = set()
+
+    async def setup(self):
+        """Ping the server and create indexes. Transient failures only warn —
+        Motor reconnects on the first successful operation."""
         try:
-            self.client = pymongo.MongoClient(config.mongodb_uri, serverSelectionTimeoutMS=5000)
-            # Test connection
-            self.client.admin.command('ping')
-            self.db = self.client["chatgpt_telegram_bot"]
-            self.user_collection = self.db["user"]
-            self.dialog_collection = self.db["dialog"]
-            # Create indexes for better query performance
-            self._create_indexes()
-        except ConnectionError as e:
-            logger.error(f"Failed to connect to MongoDB: {e}")
-            raise ConnectionError("Could not connect to MongoDB database")
-
-    def _create_indexes(self):
+            await self.client.admin.command('ping')
+            await self._create_indexes()
+        except PyMongoError as e:
+            logger.warning(f"MongoDB not reachable at startup (will retry on first query): {e}")
+
+    async def _create_indexes(self):
         """Create indexes for efficient queries."""
-        self.user_collection.create_index([("_id", pymongo.ASCENDING)], unique=True)
-        self.dialog_collection.create_index([("user_id", pymongo.ASCENDING), ("start_time", pymongo.DESCENDING)])
-        self.dialog_collection.create_index([("_id", pymongo.ASCENDING)], unique=True)
+        await self.user_collection.create_index([("_id", pymongo.ASCENDING)], unique=True)
+        await self.user_collection.create_index("last_interaction")
+        await self.dialog_collection.create_index([("user_id", pymongo.ASCENDING), ("start_time", pymongo.DESCENDING)])
+        await self.dialog_collection.create_index([("_id", pymongo.ASCENDING)], unique=True)
+        # TTL index: mongod expires dialogs untouched for dialog_ttl_seconds,
+        # keeping the collection (and its indexes) bounded in size.
+        await self.dialog_collection.create_index("start_time", expireAfterSeconds=config.dialog_ttl_seconds)
 
-    def check_if_user_exists(self, user_id: int, raise_exception: bool = False) -> bool:
+    async def check_if_user_exists(self, user_id: int, raise_exception: bool = False) -> bool:
         """
         Check if a user exists in the database.
         Args:
@@ -44,13 +70,16 @@ class Database:
         """
         if not isinstance(user_id, int):
             raise ValueError("user_id must be an integer")
-        if self.user_collection.count_documents({"_id": user_id}) > 0:
+        if user_id in self._known_users:
+            return True
+        if await self.user_collection.find_one({"_id": user_id}, {"_id": 1}) is not None:
+            self._known_users.add(user_id)
             return True
         if raise_exception:
             raise ValueError(f"User {user_id} does not exist")
         return False
 
-    def add_new_user(
+    async def add_new_user(
         self,
         user_id: int,
         chat_id: int,
@@ -69,7 +98,7 @@ class Database:
         """
         if not isinstance(user_id, int) or not isinstance(chat_id, int):
             raise ValueError("user_id and chat_id must be integers")
-        if not self.check_if_user_exists(user_id):
+        if not await self.check_if_user_exists(user_id):
             user_dict = {
                 "_id": user_id,
                 "chat_id": chat_id,
@@ -86,13 +115,14 @@ class Database:
                 "n_transcribed_seconds": 0.0
             }
             try:
-                self.user_collection.insert_one(user_dict)
+                await self.user_collection.insert_one(user_dict)
+                self._known_users.add(user_id)
                 logger.info(f"Added new user: {user_id}")
             except pymongo.errors.PyMongoError as e:
                 logger.error(f"Failed to add new user {user_id}: {e}")
                 raise
 
-    def start_new_dialog(self, user_id: int) -> str:
+    async def start_new_dialog(self, user_id: int) -> str:
         """
         Start a new dialog for the user.
         Args:
@@ -100,29 +130,46 @@ class Database:
         Returns:
             str: New dialog ID
         """
-        self.check_if_user_exists(user_id, raise_exception=True)
+        user_dict = await self.user_collection.find_one(
+            {"_id": user_id},
+            {"current_chat_mode": 1, "current_model": 1}
+        )
+        if user_dict is None:
+            raise ValueError(f"User {user_id} does not exist")
         dialog_id = str(uuid.uuid4())
         dialog_dict = {
             "_id": dialog_id,
             "user_id": user_id,
-            "chat_mode": self.get_user_attribute(user_id, "current_chat_mode"),
+            "chat_mode": user_dict.get("current_chat_mode"),
             "start_time": datetime.now(),
-            "model": self.get_user_attribute(user_id, "current_model"),
+            "model": user_dict.get("current_model"),
             "messages": []
         }
         try:
-            self.dialog_collection.insert_one(dialog_dict)
-            self.user_collection.update_one(
-                {"_id": user_id},
-                {"$set": {"current_dialog_id": dialog_id}}
+            # The two writes are independent (the dialog doc already carries its
+            # id), so pipeline them instead of paying two sequential round-trips.
+            await asyncio.gather(
+                self.dialog_collection.insert_one(dialog_dict),
+                self.user_collection.update_one(
+                    {"_id": user_id},
+                    {"$set": {"current_dialog_id": dialog_id}}
+                ),
             )
+            self._current_dialog_cache[user_id] = (dialog_id, time.monotonic())
             logger.info(f"Started new dialog {dialog_id} for user {user_id}")
             return dialog_id
         except pymongo.errors.PyMongoError as e:
             logger.error(f"Failed to start new dialog for user {user_id}: {e}")
+            # Best-effort cleanup so a failed user update doesn't leave an
+            # orphan dialog behind (no multi-document transactions without a
+            # replica set).
+            try:
+                await self.dialog_collection.delete_one({"_id": dialog_id})
+            except pymongo.errors.PyMongoError:
+                pass
             raise
 
-    def get_user_attribute(self, user_id: int, key: str) -> Any:
+    async def get_user_attribute(self, user_id: int, key: str) -> Any:
         """
         Get a user attribute by key.
         Args:
@@ -131,11 +178,12 @@ class Database:
         Returns:
             Any: Attribute value or None if not found
         """
-        self.check_if_user_exists(user_id, raise_exception=True)
-        user_dict = self.user_collection.find_one({"_id": user_id})
+        user_dict = await self.user_collection.find_one({"_id": user_id}, {key: 1, "_id": 0})
+        if user_dict is None:
+            raise ValueError(f"User {user_id} does not exist")
         return user_dict.get(key)
 
-    def set_user_attribute(self, user_id: int, key: str, value: Any) -> None:
+    async def set_user_attribute(self, user_id: int, key: str, value: Any) -> None:
         """
         Set a user attribute.
         Args:
@@ -143,15 +191,18 @@ class Database:
             key: Attribute key
             value: Attribute value
         """
-        self.check_if_user_exists(user_id, raise_exception=True)
         try:
-            self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+            result = await self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+            if result.matched_count == 0:
+                raise ValueError(f"User {user_id} does not exist")
+            if key == "current_dialog_id":
+                self._current_dialog_cache[user_id] = (value, time.monotonic())
             logger.debug(f"Set attribute {key} for user {user_id}")
         except pymongo.errors.PyMongoError as e:
             logger.error(f"Failed to set attribute {key} for user {user_id}: {e}")
             raise
 
-    def update_n_used_tokens(self, user_id: int, model: str, n_input_tokens: int, n_output_tokens: int) -> None:
+    async def update_n_used_tokens(self, user_id: int, model: str, n_input_tokens: int, n_output_tokens: int) -> None:
         """
         Update the number of used tokens for a user and model.
         Args:
@@ -162,22 +213,40 @@ class Database:
         """
         if not isinstance(n_input_tokens, int) or not isinstance(n_output_tokens, int):
             raise ValueError("n_input_tokens and n_output_tokens must be integers")
-        n_used_tokens_dict = self.get_user_attribute(user_id, "n_used_tokens") or {}
-        if model in n_used_tokens_dict:
-            n_used_tokens_dict[model]["n_input_tokens"] += n_input_tokens
-            n_used_tokens_dict[model]["n_output_tokens"] += n_output_tokens
-        else:
-            n_used_tokens_dict[model] = {
-                "n_input_tokens": n_input_tokens,
-                "n_output_tokens": n_output_tokens
-            }
         try:
-            self.set_user_attribute(user_id, "n_used_tokens", n_used_tokens_dict)
+            # Single atomic $inc: MongoDB creates missing nested fields automatically,
+            # so no read-modify-write cycle (and no lost updates under concurrency).
+            result = await self.user_collection.update_one(
+                {"_id": user_id},
+                {"$inc": {
+                    f"n_used_tokens.{model}.n_input_tokens": n_input_tokens,
+                    f"n_used_tokens.{model}.n_output_tokens": n_output_tokens
+                }}
+            )
+            if result.matched_count == 0:
+                raise ValueError(f"User {user_id} does not exist")
         except pymongo.errors.PyMongoError as e:
             logger.error(f"Failed to update tokens for user {user_id}: {e}")
             raise
 
-    def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None) -> List[Dict]:
+    async def _get_current_dialog_id(self, user_id: int) -> Optional[str]:
+        """
+        Get the user's current dialog ID, using the per-process cache when fresh.
+        Args:
+            user_id: Telegram user ID
+        Returns:
+            Optional[str]: Current dialog ID or None
+        """
+        cached = self._current_dialog_cache.get(user_id)
+        if cached is not None:
+            dialog_id, cached_at = cached
+            if time.monotonic() - cached_at < config.new_dialog_timeout:
+                return dialog_id
+        dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+        self._current_dialog_cache[user_id] = (dialog_id, time.monotonic())
+        return dialog_id
+
+    async def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None) -> List[Dict]:
         """
         Get messages for a dialog.
         Args:
@@ -186,17 +255,16 @@ class Database:
         Returns:
             List[Dict]: List of dialog messages
         """
-        self.check_if_user_exists(user_id, raise_exception=True)
         if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+            dialog_id = await self._get_current_dialog_id(user_id)
         if not dialog_id:
             return []
-        dialog_dict = self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id})
+        dialog_dict = await self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id}, {"messages": 1})
         if not dialog_dict:
             raise ValueError(f"Dialog {dialog_id} not found for user {user_id}")
         return dialog_dict.get("messages", [])
 
-    def set_dialog_messages(self, user_id: int, dialog_messages: List[Dict], dialog_id: Optional[str] = None) -> None:
+    async def set_dialog_messages(self, user_id: int, dialog_messages: List[Dict], dialog_id: Optional[str] = None) -> None:
         """
         Set messages for a dialog.
         Args:
@@ -204,22 +272,47 @@ class Database:
             dialog_messages: List of dialog messages
             dialog_id: Dialog ID (optional, defaults to current dialog)
         """
-        self.check_if_user_exists(user_id, raise_exception=True)
         if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+            dialog_id = await self._get_current_dialog_id(user_id)
         if not dialog_id:
             raise ValueError("No current dialog found")
         try:
-            self.dialog_collection.update_one(
+            result = await self.dialog_collection.update_one(
                 {"_id": dialog_id, "user_id": user_id},
                 {"$set": {"messages": dialog_messages}}
             )
+            if result.matched_count == 0:
+                raise ValueError(f"Dialog {dialog_id} not found for user {user_id}")
             logger.debug(f"Updated messages for dialog {dialog_id} of user {user_id}")
         except pymongo.errors.PyMongoError as e:
             logger.error(f"Failed to set dialog messages for user {user_id}: {e}")
             raise
 
-    def get_user_dialogs(self, user_id: int) -> List[Dict]:
+    async def append_dialog_message(self, user_id: int, dialog_message: Dict, dialog_id: Optional[str] = None) -> None:
+        """
+        Append a single message to a dialog.
+        Args:
+            user_id: Telegram user ID
+            dialog_message: Dialog message dict to append
+            dialog_id: Dialog ID (optional, defaults to current dialog)
+        """
+        if dialog_id is None:
+            dialog_id = await self._get_current_dialog_id(user_id)
+        if not dialog_id:
+            raise ValueError("No current dialog found")
+        try:
+            result = await self.dialog_collection.update_one(
+                {"_id": dialog_id, "user_id": user_id},
+                {"$push": {"messages": dialog_message}}
+            )
+            if result.matched_count == 0:
+                raise ValueError(f"Dialog {dialog_id} not found for user {user_id}")
+            logger.debug(f"Appended message to dialog {dialog_id} of user {user_id}")
+        except pymongo.errors.PyMongoError as e:
+            logger.error(f"Failed to append dialog message for user {user_id}: {e}")
+            raise
+
+    async def get_user_dialogs(self, user_id: int) -> List[Dict]:
         """
         Get all dialogs for a user.
         Args:
@@ -227,9 +320,13 @@ class Database:
         Returns:
             List[Dict]: List of dialog metadata (id, start_time, chat_mode, model)
         """
-        self.check_if_user_exists(user_id, raise_exception=True)
-        dialogs = self.dialog_collection.find({"user_id": user_id}, {"_id": 1, "start_time": 1, "chat_mode": 1, "model": 1})
-        return list(dialogs)
+        await self.check_if_user_exists(user_id, raise_exception=True)
+        cursor = (
+            self.dialog_collection
+            .find({"user_id": user_id}, {"_id": 1, "start_time": 1, "chat_mode": 1, "model": 1})
+            .sort("start_time", pymongo.DESCENDING)
+        )
+        return await cursor.to_list(length=None)
 
     def close(self):
         """Close the MongoDB client connection."""
@@ -239,6 +336,7 @@ class Database:
         except Exception as e:
             logger.error(f"Failed to close MongoDB connection: {e}")
 
-    def __del__(self):
-        """Ensure MongoDB connection is closed when object is destroyed."""
-        self.close()
\ No newline at end of file
+
+# Module-level singleton: one MongoClient (and its connection pool) shared
+# by the whole process. Import as `from database import db`.
+db = Database()
\ No newline at end of file
@@ -3,9 +3,7 @@
 import config
 import google.generativeai as genai
 import asyncio
-
-# تنظیمات Gemini
-genai.configure(api_key=config.gemini_api_key)
+from functools import lru_cache
 
 GEMINI_COMPLETION_OPTIONS = {
     "temperature": 0.7,
@@ -13,56 +11,93 @@ GEMINI_COMPLETION_OPTIONS = {
     "top_p": 1,
 }
 
+# تنظیمات Gemini — تنبل، تا استارت سرد سریع بماند و تست‌های آفلاین
+# بدون کلید Gemini قابل اجرا باشند
+_gemini_configured = False
+
+
+def _configure_once():
+    global _gemini_configured
+    if not _gemini_configured:
+        genai.configure(api_key=config.gemini_api_key)
+        _gemini_configured = True
+
+
+@lru_cache(maxsize=32)
+def _get_model(model_name: str, system_instruction: str):
+    """مدل‌های GenerativeModel را بر اساس (نام مدل، پرامپت سیستم) کش می‌کند
+    تا ساختن GeminiChat به ازای هر پیام، مدل جدیدی نسازد."""
+    _configure_once()
+    return genai.GenerativeModel(model_name=model_name, system_instruction=system_instruction)
+
+
 class GeminiChat:
     def __init__(self, model="gemini-1.5-flash"):
         self.model = model
-        self.client = genai.GenerativeModel(model_name=model)
 
     async def send_message(self, message, dialog_messages=[], chat_mode="assistant"):
-        if chat_mode not in config.chat_modes.keys():
+        if chat_mode not in config.chat_mode_names:
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
         try:
-            # ساخت پرامپت با تاریخچه مکالمه
-            messages = self._generate_prompt_messages(message, dialog_messages, chat_mode)
-            response = await asyncio.to_thread(self.client.generate_content, messages)
+            # ساخت پرامپت با تاریخچه مکالمه — پرامپت حالت چت به صورت
+            # system_instruction بومی Gemini به مدل داده می‌شود
+            prompt_start = config.chat_mode_prompts[chat_mode]
+            model = _get_model(self.model, prompt_start)
+            # پنجره لغزان: فقط آخرین max_dialog_turns نوبت به پرامپت می‌رود
+            # تا هزینه توکن و تأخیر Gemini با طول مکالمه رشد نکند
+            n_first_dialog_messages_removed = max(0, len(dialog_messages) - config.max_dialog_turns)
+            if n_first_dialog_messages_removed > 0:
+                dialog_messages = dialog_messages[-config.max_dialog_turns:]
+            messages = self._generate_prompt_messages(message, dialog_messages)
+            response = await asyncio.to_thread(model.generate_content, messages)
             answer = response.text
 
             # محاسبه توکن‌ها (Gemini توکن‌ها را مستقیم گزارش نمی‌دهد، این تقریبی است)
-            n_input_tokens = len(" ".join([m["content"] for m in messages]).split())
+            # جمع شمارش هر پیام جداگانه — بدون ساخت رشته الحاقی بزرگ در حافظه
+            n_input_tokens = sum(len(m["content"].split()) for m in messages) + len(prompt_start.split())
             n_output_tokens = len(answer.split())
 
             answer = self._postprocess_answer(answer)
-            return answer, (n_input_tokens, n_output_tokens), 0
+            return answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
 
         except Exception as e:
             raise ValueError(f"Error in Gemini API: {str(e)}")
 
     async def send_message_stream(self, message, dialog_messages=[], chat_mode="assistant"):
-        if chat_mode not in config.chat_modes.keys():
+        if chat_mode not in config.chat_mode_names:
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
         try:
-            messages = self._generate_prompt_messages(message, dialog_messages, chat_mode)
-            response = await asyncio.to_thread(self.client.generate_content, messages, stream=True)
-
+            prompt_start = config.chat_mode_prompts[chat_mode]
+            model = _get_model(self.model, prompt_start)
+            n_first_dialog_messages_removed = max(0, len(dialog_messages) - config.max_dialog_turns)
+            if n_first_dialog_messages_removed > 0:
+                dialog_messages = dialog_messages[-config.max_dialog_turns:]
+            messages = self._generate_prompt_messages(message, dialog_messages)
+            response = await asyncio.to_thread(model.generate_content, messages, stream=True)
+
+            # محاسبه توکن‌های ورودی یک بار، و شمارش افزایشی توکن‌های خروجی —
+            # شمارش مجدد کل answer در هر chunk هزینه O(N²) روی طول پاسخ دارد
             answer = ""
-            n_input_tokens = len(" ".join([m["content"] for m in messages]).split())
+            n_input_tokens = sum(len(m["content"].split()) for m in messages) + len(prompt_start.split())
+            n_output_tokens = 0
             async for chunk in response:
                 if chunk.text:
                     answer += chunk.text
-                    n_output_tokens = len(answer.split())
-                    yield "not_finished", answer, (n_input_tokens, n_output_tokens), 0
+                    n_output_tokens += len(chunk.text.split())
+                    yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
 
             answer = self._postprocess_answer(answer)
-            yield "finished", answer, (n_input_tokens, n_output_tokens), 0
+            yield "finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
 
         except Exception as e:
             raise ValueError(f"Error in Gemini API: {str(e)}")
 
-    def _generate_prompt_messages(self, message, dialog_messages, chat_mode):
-        prompt = config.chat_modes[chat_mode]["prompt_start"]
-        messages = [{"role": "system", "content": prompt}]
+    def _generate_prompt_messages(self, message, dialog_messages):
+        # پرامپت سیستم دیگر به صورت پیام ساختگی اضافه نمی‌شود —
+        # به عنوان system_instruction مدل تنظیم شده است
+        messages = []
 
         for dialog_message in dialog_messages:
             messages.append({"role": "user", "content": dialog_message["user"]})